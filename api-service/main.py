@@ -2,8 +2,10 @@ from flask import Flask, request, jsonify
 import redis
 import json
 import os
+import time
 import uuid
 import logging
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pythonjsonlogger.json import JsonFormatter
 
@@ -17,6 +19,50 @@ formatter = JsonFormatter("%(message)s %(asctime)s %(levelname)s")
 handler.setFormatter(formatter)
 log.addHandler(handler)
 
+# Stage tracing: one JSON line per span, to stdout or TRACE_FILE ("none" disables)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "/tmp/traces.jsonl")
+if TRACE_EXPORTER not in ("none", "stdout", "file"):
+    log.warning("Unknown TRACE_EXPORTER, tracing disabled", extra={"trace_exporter": TRACE_EXPORTER})
+    TRACE_EXPORTER = "none"
+
+
+def export_span(name: str, trace_id: str, start: float, end: float, **attrs):
+    """Write one finished span to the configured exporter. Exporter errors are logged, never raised."""
+    if TRACE_EXPORTER not in ("stdout", "file") or not trace_id:
+        return
+    try:
+        record = json.dumps({
+            "trace_id": trace_id,
+            "span_id": uuid.uuid4().hex[:16],
+            "name": name,
+            "service": "api",
+            "start": start,
+            "duration_ms": round((end - start) * 1000, 3),
+            **attrs,
+        })
+        if TRACE_EXPORTER == "file":
+            with open(TRACE_FILE, "a") as f:
+                f.write(record + "\n")
+        else:
+            print(record, flush=True)
+    except Exception as e:
+        # Tracing must never change job control flow (e.g. a 500 after the job was already queued)
+        log.warning("Span export failed", extra={"span": name, "trace_id": trace_id, "error": str(e)})
+
+
+@contextmanager
+def span(name: str, trace_id: str, **attrs):
+    """Time a stage and export it as a span. The yielded dict can be updated with attributes."""
+    start = time.time()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs["error"] = str(e)
+        raise
+    finally:
+        export_span(name, trace_id, start, time.time(), **attrs)
+
 # Connect to Redis (decode_responses=True for string values in hashes/lists)
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
@@ -29,6 +75,9 @@ JOB_TTL_SECONDS = 604800
 JOB_QUEUE_KEY = "job_queue"
 METRICS_KEYS = ("metrics:jobs_submitted", "metrics:jobs_completed", "metrics:jobs_failed")
 
+# Statuses from which a job can no longer be cancelled
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
 
 @app.route("/health", methods=["GET"])
 def health():
@@ -40,32 +89,219 @@ def health():
         return "", 503
 
 
-@app.route("/submit", methods=["POST"])
-def submit_job():
-    data = request.json
-    if not data or "task" not in data:
-        log.warning("Submit failed: missing task", extra={"path": "/submit", "status_code": 400})
-        return jsonify({"error": "Missing 'task' field"}), 400
+def invalid_timeout(timeout_seconds) -> bool:
+    """True if timeout_seconds is set but not a positive number."""
+    return timeout_seconds is not None and (
+        isinstance(timeout_seconds, bool) or not isinstance(timeout_seconds, (int, float)) or timeout_seconds <= 0
+    )
+
+
+def release_if_ready(job_id: str, parent_id: str) -> bool:
+    """Mark parent_id done for a waiting job; the caller that removes its last pending parent pushes it to job_queue.
+
+    SREM is idempotent per parent, so a parent that completes twice (e.g. requeued by the reconciler while
+    still running) cannot release its children early.
+    """
+    key = f"job:{job_id}"
+    pipeline = r.pipeline()
+    pipeline.srem(f"{key}:pending", parent_id)
+    pipeline.scard(f"{key}:pending")
+    removed, remaining = pipeline.execute()
+    if not removed or remaining != 0:
+        return False
+    status, cancel_requested = r.hmget(key, "status", "cancel_requested")
+    if status != "waiting" or cancel_requested:
+        return False
+    payload = json.loads(r.hget(key, "payload"))
+    payload["enqueued_at"] = time.time()  # Queue wait starts at release, not at submit
+    payload_json = json.dumps(payload)
+    pipeline = r.pipeline()
+    pipeline.hset(key, mapping={"status": "queued", "payload": payload_json})
+    pipeline.rpush(JOB_QUEUE_KEY, payload_json)
+    pipeline.execute()
+    return True
+
 
+def cancel_dependents(job_id: str, reason: str):
+    """Cancel every waiting job downstream of job_id (depth-first over job:<id>:children)."""
+    stack = [job_id]
+    while stack:
+        parent_id = stack.pop()
+        for child_id in r.smembers(f"job:{parent_id}:children"):
+            if r.hget(f"job:{child_id}", "status") != "waiting":
+                continue
+            r.hset(f"job:{child_id}", mapping={
+                "status": "cancelled",
+                "error": f"Dependency {job_id} {reason}",
+                "cancel_requested": "1",
+                "cancelled_at": datetime.now(timezone.utc).isoformat(),
+            })
+            log.info(
+                "Job cancelled by dependency",
+                extra={"job_id": child_id, "status": "cancelled", "parent_id": job_id, "reason": reason},
+            )
+            stack.append(child_id)
+
+
+def create_job(task, trace_id, timeout_seconds=None, depends_on=()) -> tuple:
+    """Create job:<id> and enqueue it, or leave it waiting until every job in depends_on completes.
+
+    Returns (job_id, status).
+    """
     job_id = str(uuid.uuid4())
     created_at = datetime.now(timezone.utc).isoformat()
-    payload = {"id": job_id, "task": data["task"], "attempts": 0, "created_at": created_at}
+    payload = {"id": job_id, "task": task, "attempts": 0, "created_at": created_at, "trace_id": trace_id}
+    if timeout_seconds is not None:
+        payload["timeout_seconds"] = timeout_seconds
+    if depends_on:
+        payload["depends_on"] = list(depends_on)
+    else:
+        payload["enqueued_at"] = time.time()
 
-    r.hset(f"job:{job_id}", mapping={
-        "status": "queued",
-        "task": data["task"],
+    mapping = {
+        "status": "waiting" if depends_on else "queued",
+        "task": task,
         "created_at": created_at,
+        "trace_id": trace_id,
         "payload": json.dumps(payload),
-    })
+    }
+    if depends_on:
+        mapping["depends_on"] = json.dumps(list(depends_on))
+    r.hset(f"job:{job_id}", mapping=mapping)
     r.expire(f"job:{job_id}", JOB_TTL_SECONDS)
-
-    r.rpush(JOB_QUEUE_KEY, json.dumps(payload))
+    if depends_on:
+        # Written before registering with parents so a parent completing concurrently finds itself pending
+        r.sadd(f"job:{job_id}:pending", *depends_on)
+        r.expire(f"job:{job_id}:pending", JOB_TTL_SECONDS)
     r.incr("metrics:jobs_submitted")
+
+    if not depends_on:
+        r.rpush(JOB_QUEUE_KEY, mapping["payload"])
+        return job_id, "queued"
+
+    for parent_id in depends_on:
+        # MULTI/EXEC: serialized against the worker's "set terminal status + read children" transaction,
+        # so either the worker or this request sees the completed parent (and SREM makes a double release harmless).
+        pipeline = r.pipeline()
+        pipeline.sadd(f"job:{parent_id}:children", job_id)
+        pipeline.expire(f"job:{parent_id}:children", JOB_TTL_SECONDS)
+        pipeline.hget(f"job:{parent_id}", "status")
+        _, _, parent_status = pipeline.execute()
+
+        if parent_status == "completed":
+            release_if_ready(job_id, parent_id)
+        elif parent_status in TERMINAL_STATUSES:
+            r.hset(f"job:{job_id}", mapping={
+                "status": "cancelled",
+                "error": f"Dependency {parent_id} {parent_status}",
+                "cancelled_at": datetime.now(timezone.utc).isoformat(),
+            })
+            break
+
+    return job_id, r.hget(f"job:{job_id}", "status")
+
+
+def topological_order(jobs: list) -> list:
+    """Order DAG nodes so parents precede children. Returns None if the batch has a cycle."""
+    refs = {job["ref"] for job in jobs}
+    remaining = {job["ref"]: {dep for dep in job.get("depends_on", []) if dep in refs} for job in jobs}
+    by_ref = {job["ref"]: job for job in jobs}
+    ordered = []
+    while remaining:
+        ready = [ref for ref, deps in remaining.items() if not deps]
+        if not ready:
+            return None
+        for ref in ready:
+            ordered.append(by_ref[ref])
+            del remaining[ref]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return ordered
+
+
+def submit_error(message: str, reason: str, **extra):
+    """Log a rejected submit and build its 400 response."""
+    log.warning(f"Submit failed: {reason}", extra={"path": "/submit", "status_code": 400, **extra})
+    return jsonify({"error": message}), 400
+
+
+def validate_job(job: dict, refs=()):
+    """Validate one job spec (single submit or DAG node). Returns a logged 400 response, or None if valid.
+
+    depends_on entries must be existing job ids or, for a DAG node, refs in the same batch.
+    """
+    if "task" not in job:
+        return submit_error("Missing 'task' field", "missing task")
+    if invalid_timeout(job.get("timeout_seconds")):
+        return submit_error("'timeout_seconds' must be a positive number", "invalid timeout_seconds")
+    depends_on = job.get("depends_on", [])
+    if not isinstance(depends_on, list) or not all(isinstance(dep, str) for dep in depends_on):
+        return submit_error("'depends_on' must be a list of job ids", "invalid depends_on")
+    for dep in depends_on:
+        if dep not in refs and not r.exists(f"job:{dep}"):
+            return submit_error(f"Unknown dependency: {dep}", "unknown dependency", depends_on=dep)
+    return None
+
+
+def submit_dag(jobs):
+    """Validate and create a batch of jobs whose depends_on may name other refs in the batch or existing job ids."""
+    if not isinstance(jobs, list) or not jobs or not all(isinstance(job, dict) for job in jobs):
+        return submit_error("'jobs' must be a non-empty list", "invalid jobs")
+
+    refs = [job.get("ref") for job in jobs]
+    if not all(isinstance(ref, str) and ref for ref in refs) or len(set(refs)) != len(refs):
+        return submit_error("Each job in 'jobs' needs a unique 'ref'", "invalid ref")
+
+    for job in jobs:
+        error = validate_job(job, refs)
+        if error:
+            return error
+
+    ordered = topological_order(jobs)
+    if ordered is None:
+        return submit_error("Dependency cycle in 'jobs'", "dependency cycle")
+
+    # One trace for the whole workflow
+    trace_id = uuid.uuid4().hex
+    ids = {}
+    created = {}
+    for job in ordered:
+        depends_on = [ids.get(dep, dep) for dep in dict.fromkeys(job.get("depends_on", []))]
+        with span("api.submit", trace_id, task=job["task"], ref=job["ref"]) as attrs:
+            job_id, status = create_job(job["task"], trace_id, job.get("timeout_seconds"), depends_on)
+            attrs.update(job_id=job_id, status=status)
+        ids[job["ref"]] = job_id
+        created[job["ref"]] = {"ref": job["ref"], "id": job_id, "task": job["task"], "status": status, "trace_id": trace_id}
+        log.info(
+            "Job submitted",
+            extra={"job_id": job_id, "task": job["task"], "status": status, "ref": job["ref"], "path": "/submit", "status_code": 200},
+        )
+
+    return jsonify({"jobs": [created[ref] for ref in refs]})
+
+
+@app.route("/submit", methods=["POST"])
+def submit_job():
+    data = request.json
+    if data and "jobs" in data:
+        return submit_dag(data["jobs"])
+
+    error = validate_job(data or {})
+    if error:
+        return error
+
+    timeout_seconds = data.get("timeout_seconds")
+    depends_on = list(dict.fromkeys(data.get("depends_on", [])))
+
+    trace_id = uuid.uuid4().hex
+    with span("api.submit", trace_id, task=data["task"]) as attrs:
+        job_id, status = create_job(data["task"], trace_id, timeout_seconds, depends_on)
+        attrs.update(job_id=job_id, status=status)
     log.info(
         "Job submitted",
-        extra={"job_id": job_id, "task": data["task"], "status": "queued", "path": "/submit", "status_code": 200},
+        extra={"job_id": job_id, "task": data["task"], "status": status, "path": "/submit", "status_code": 200},
     )
-    return jsonify({"status": "queued", "task": data["task"], "id": job_id})
+    return jsonify({"status": status, "task": data["task"], "id": job_id, "trace_id": trace_id})
 
 
 @app.route("/jobs/<job_id>", methods=["GET"])
@@ -87,8 +323,17 @@ def get_job(job_id):
         resp["completed_at"] = d["completed_at"]
     if d.get("error") is not None:
         resp["error"] = d["error"]
+    if d.get("error_type") is not None:
+        resp["error_type"] = d["error_type"]
     if d.get("failed_at") is not None:
         resp["failed_at"] = d["failed_at"]
+    if d.get("cancelled_at") is not None:
+        resp["cancelled_at"] = d["cancelled_at"]
+    if d.get("trace_id") is not None:
+        resp["trace_id"] = d["trace_id"]
+    if d.get("depends_on") is not None:
+        resp["depends_on"] = json.loads(d["depends_on"])
+        resp["pending_deps"] = r.scard(f"job:{job_id}:pending")
     log.info(
         "Job status retrieved",
         extra={"job_id": job_id, "task": d["task"], "status": d["status"], "path": f"/jobs/{job_id}", "status_code": 200},
@@ -96,6 +341,51 @@ def get_job(job_id):
     return jsonify(resp)
 
 
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    """Cancel a job and its waiting dependents. Queued/waiting jobs are cancelled (200); running jobs are signalled (202)."""
+    key = f"job:{job_id}"
+    d = r.hgetall(key)
+    if not d:
+        log.info(
+            "Job not found",
+            extra={"job_id": job_id, "status": "not_found", "path": f"/jobs/{job_id}/cancel", "status_code": 404},
+        )
+        return jsonify({"error": "Job not found"}), 404
+
+    if d["status"] in TERMINAL_STATUSES:
+        log.info(
+            "Cancel rejected: job already finished",
+            extra={"job_id": job_id, "status": d["status"], "path": f"/jobs/{job_id}/cancel", "status_code": 409},
+        )
+        return jsonify({"error": f"Job already {d['status']}"}), 409
+
+    # Flag first so a worker that pops the job concurrently with LREM still sees the request
+    r.hset(key, "cancel_requested", "1")
+
+    removed = 0
+    if d["status"] == "queued" and d.get("payload"):
+        removed = r.lrem(JOB_QUEUE_KEY, 1, d["payload"])
+
+    # Waiting jobs are not in job_queue yet. If a release races with this request and pushes the job anyway,
+    # the worker sees cancel_requested at claim time and skips it.
+    if removed or d["status"] == "waiting":
+        r.hset(key, mapping={"status": "cancelled", "cancelled_at": datetime.now(timezone.utc).isoformat()})
+        cancel_dependents(job_id, "cancelled")
+        log.info(
+            "Job cancelled",
+            extra={"job_id": job_id, "task": d["task"], "status": "cancelled", "path": f"/jobs/{job_id}/cancel", "status_code": 200},
+        )
+        return jsonify({"status": "cancelled", "id": job_id})
+
+    # Already claimed by a worker: its watchdog picks up cancel_requested and terminates the handler
+    log.info(
+        "Job cancellation requested",
+        extra={"job_id": job_id, "task": d["task"], "status": "cancelling", "path": f"/jobs/{job_id}/cancel", "status_code": 202},
+    )
+    return jsonify({"status": "cancelling", "id": job_id}), 202
+
+
 @app.route("/metrics", methods=["GET"])
 def metrics():
     """Return job counters and queue depth (LLEN job_queue). Counters are updated by API (submitted) and workers (completed, failed)."""
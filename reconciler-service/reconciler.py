@@ -2,6 +2,8 @@ import redis
 import json
 import time
 import os
+import uuid
+from contextlib import contextmanager
 from datetime import datetime, timezone
 import logging
 from pythonjsonlogger.json import JsonFormatter
@@ -11,6 +13,8 @@ REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 STALE_THRESHOLD_SECONDS = int(os.getenv("STALE_THRESHOLD_SECONDS", 300))  # 5 min
 RECONCILER_INTERVAL = int(os.getenv("RECONCILER_INTERVAL", 60))  # 1 min
 MAX_ATTEMPTS = 4
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")  # none | stdout | file
+TRACE_FILE = os.getenv("TRACE_FILE", "/tmp/traces.jsonl")
 
 r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
 
@@ -21,7 +25,47 @@ formatter = JsonFormatter("%(message)s %(asctime)s %(levelname)s")
 handler.setFormatter(formatter)
 log.addHandler(handler)
 
-log.info("Reconciler starting", extra={"interval": RECONCILER_INTERVAL, "threshold": STALE_THRESHOLD_SECONDS})
+if TRACE_EXPORTER not in ("none", "stdout", "file"):
+    log.warning("Unknown TRACE_EXPORTER, tracing disabled", extra={"trace_exporter": TRACE_EXPORTER})
+    TRACE_EXPORTER = "none"
+
+
+def export_span(name: str, trace_id: str, start: float, end: float, **attrs):
+    """Write one finished span to the configured exporter. Exporter errors are logged, never raised."""
+    if TRACE_EXPORTER not in ("stdout", "file") or not trace_id:
+        return
+    try:
+        record = json.dumps({
+            "trace_id": trace_id,
+            "span_id": uuid.uuid4().hex[:16],
+            "name": name,
+            "service": "reconciler",
+            "start": start,
+            "duration_ms": round((end - start) * 1000, 3),
+            **attrs,
+        })
+        if TRACE_EXPORTER == "file":
+            with open(TRACE_FILE, "a") as f:
+                f.write(record + "\n")
+        else:
+            print(record, flush=True)
+    except Exception as e:
+        # Tracing must never change job control flow (e.g. a 500 after the job was already queued)
+        log.warning("Span export failed", extra={"span": name, "trace_id": trace_id, "error": str(e)})
+
+
+@contextmanager
+def span(name: str, trace_id: str, **attrs):
+    """Time a stage and export it as a span. The yielded dict can be updated with attributes."""
+    start = time.time()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs["error"] = str(e)
+        raise
+    finally:
+        export_span(name, trace_id, start, time.time(), **attrs)
+
 
 def reconcile_jobs():
     """Check processing_jobs ZSET for stale entries."""
@@ -88,12 +132,16 @@ def reconcile_job(job_id: str):
     if attempts < MAX_ATTEMPTS:
         # REQUEUE
         payload["attempts"] = attempts
+        payload["enqueued_at"] = time.time()
+        payload_json = json.dumps(payload)
         
-        pipeline = r.pipeline()
-        pipeline.hset(f"job:{job_id}", mapping={"status": "queued", "attempts": str(attempts)})
-        pipeline.rpush("job_queue", json.dumps(payload))
-        pipeline.zrem("processing_jobs", job_id) # Remove from processing set
-        pipeline.execute()
+        with span("reconciler.requeue", payload.get("trace_id"), job_id=job_id, task=task, attempts=attempts):
+            pipeline = r.pipeline()
+            # Keep stored payload in sync with the queued copy so cancel can LREM it
+            pipeline.hset(f"job:{job_id}", mapping={"status": "queued", "attempts": str(attempts), "payload": payload_json})
+            pipeline.rpush("job_queue", payload_json)
+            pipeline.zrem("processing_jobs", job_id) # Remove from processing set
+            pipeline.execute()
         
         log.warning("Stale job requeued", extra=extra_log)
     else:
@@ -101,6 +149,27 @@ def reconcile_job(job_id: str):
         fail_job_dlq(job_id, payload, attempts, f"Reconciler: Stale after {STALE_THRESHOLD_SECONDS}s")
 
 
+def cancel_dependents(job_id: str, reason: str):
+    """Cancel every waiting job downstream of job_id (depth-first over job:<id>:children)."""
+    stack = [job_id]
+    while stack:
+        parent_id = stack.pop()
+        for child_id in r.smembers(f"job:{parent_id}:children"):
+            if r.hget(f"job:{child_id}", "status") != "waiting":
+                continue
+            r.hset(
+                f"job:{child_id}",
+                mapping={
+                    "status": "cancelled",
+                    "error": f"Dependency {job_id} {reason}",
+                    "cancel_requested": "1",
+                    "cancelled_at": datetime.now(timezone.utc).isoformat(),
+                }
+            )
+            log.info("Job cancelled by dependency", extra={"job_id": child_id, "parent_id": job_id, "reason": reason})
+            stack.append(child_id)
+
+
 def fail_job_missing_payload(job_id, error_msg, attempts):
     """Fail a job that has no payload to push to DLQ."""
     r.hset(
@@ -114,33 +183,43 @@ def fail_job_missing_payload(job_id, error_msg, attempts):
     r.zrem("processing_jobs", job_id)
     r.incr("metrics:jobs_failed")
     log.error("Stale job failed (no payload)", extra={"job_id": job_id, "error": error_msg})
+    cancel_dependents(job_id, "failed")
 
 
 def fail_job_dlq(job_id, payload, attempts, error_msg):
     """Move job to failed state and DLQ."""
     payload["attempts"] = attempts
     
-    pipeline = r.pipeline()
-    pipeline.hset(
-        f"job:{job_id}",
-        mapping={
-            "status": "failed",
-            "error": error_msg,
-            "failed_at": datetime.now(timezone.utc).isoformat(),
-        }
-    )
-    pipeline.rpush("dead_letter", json.dumps(payload))
-    pipeline.zrem("processing_jobs", job_id)
-    pipeline.incr("metrics:jobs_failed")
-    pipeline.execute()
+    with span("reconciler.dlq", payload.get("trace_id"), job_id=job_id, attempts=attempts):
+        pipeline = r.pipeline()
+        pipeline.hset(
+            f"job:{job_id}",
+            mapping={
+                "status": "failed",
+                "error": error_msg,
+                "failed_at": datetime.now(timezone.utc).isoformat(),
+            }
+        )
+        pipeline.rpush("dead_letter", json.dumps(payload))
+        pipeline.zrem("processing_jobs", job_id)
+        pipeline.incr("metrics:jobs_failed")
+        pipeline.execute()
+        cancel_dependents(job_id, "failed")
     
     log.error("Stale job moved to DLQ", extra={"job_id": job_id, "error": error_msg})
 
 
-while True:
-    try:
-        reconcile_jobs()
-    except Exception as e:
-        log.error("Reconciler loop error", extra={"error": str(e)})
-    
-    time.sleep(RECONCILER_INTERVAL)
+def main():
+    log.info("Reconciler starting", extra={"interval": RECONCILER_INTERVAL, "threshold": STALE_THRESHOLD_SECONDS})
+
+    while True:
+        try:
+            reconcile_jobs()
+        except Exception as e:
+            log.error("Reconciler loop error", extra={"error": str(e)})
+        
+        time.sleep(RECONCILER_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
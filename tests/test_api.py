@@ -132,3 +132,262 @@ def test_metrics_redis_down(client):
     resp = c.get("/metrics")
     assert resp.status_code == 503
     assert resp.get_json() == {"error": "Redis unreachable"}
+
+
+def test_submit_with_timeout(client):
+    """POST /submit carries timeout_seconds into the queued payload."""
+    import json
+    c, mock_r = client
+
+    resp = c.post("/submit", json={"task": "slow", "timeout_seconds": 30})
+    assert resp.status_code == 200
+    queued = json.loads(mock_r.rpush.call_args[0][1])
+    assert queued["timeout_seconds"] == 30
+
+
+def test_submit_invalid_timeout(client):
+    """POST /submit returns 400 when timeout_seconds is not a positive number."""
+    c, mock_r = client
+
+    for bad in (0, -5, "10", True):
+        resp = c.post("/submit", json={"task": "slow", "timeout_seconds": bad})
+        assert resp.status_code == 400
+        assert resp.get_json() == {"error": "'timeout_seconds' must be a positive number"}
+    mock_r.rpush.assert_not_called()
+
+
+def test_cancel_not_found(client):
+    """POST /jobs/:id/cancel returns 404 when job does not exist."""
+    c, mock_r = client
+    mock_r.hgetall.return_value = {}
+
+    resp = c.post("/jobs/some-uuid/cancel")
+    assert resp.status_code == 404
+    assert resp.get_json() == {"error": "Job not found"}
+
+
+def test_cancel_finished_job(client):
+    """POST /jobs/:id/cancel returns 409 when job already reached a terminal status."""
+    c, mock_r = client
+    mock_r.hgetall.return_value = {"status": "completed", "task": "hello"}
+
+    resp = c.post("/jobs/some-uuid/cancel")
+    assert resp.status_code == 409
+    assert resp.get_json() == {"error": "Job already completed"}
+    mock_r.hset.assert_not_called()
+
+
+def test_cancel_queued_job(client):
+    """POST /jobs/:id/cancel removes a queued job from job_queue and marks it cancelled."""
+    c, mock_r = client
+    mock_r.hgetall.return_value = {"status": "queued", "task": "hello", "payload": '{"id": "some-uuid"}'}
+    mock_r.lrem.return_value = 1
+
+    resp = c.post("/jobs/some-uuid/cancel")
+    assert resp.status_code == 200
+    assert resp.get_json() == {"status": "cancelled", "id": "some-uuid"}
+    mock_r.lrem.assert_called_once_with("job_queue", 1, '{"id": "some-uuid"}')
+    assert mock_r.hset.call_args[1]["mapping"]["status"] == "cancelled"
+
+
+def test_cancel_processing_job(client):
+    """POST /jobs/:id/cancel signals the worker (202) when the job is already running."""
+    c, mock_r = client
+    mock_r.hgetall.return_value = {"status": "processing", "task": "hello", "payload": '{"id": "some-uuid"}'}
+
+    resp = c.post("/jobs/some-uuid/cancel")
+    assert resp.status_code == 202
+    assert resp.get_json() == {"status": "cancelling", "id": "some-uuid"}
+    mock_r.lrem.assert_not_called()
+    mock_r.hset.assert_called_once_with("job:some-uuid", "cancel_requested", "1")
+
+
+def test_submit_unknown_dependency(client):
+    """POST /submit returns 400 when depends_on names a job that does not exist."""
+    c, mock_r = client
+    mock_r.exists.return_value = 0
+
+    resp = c.post("/submit", json={"task": "step2", "depends_on": ["missing-uuid"]})
+    assert resp.status_code == 400
+    assert resp.get_json() == {"error": "Unknown dependency: missing-uuid"}
+
+
+def test_submit_waits_on_running_parent(client):
+    """POST /submit leaves a job waiting (not in job_queue) while its parent is still running."""
+    c, mock_r = client
+    mock_r.exists.return_value = 1
+    mock_r.pipeline.return_value.execute.return_value = [1, True, "processing"]
+    mock_r.hget.return_value = "waiting"
+
+    resp = c.post("/submit", json={"task": "step2", "depends_on": ["parent-uuid"]})
+    assert resp.status_code == 200
+    assert resp.get_json()["status"] == "waiting"
+    mock_r.rpush.assert_not_called()
+    job_id = resp.get_json()["id"]
+    mock_r.pipeline.return_value.sadd.assert_called_once_with("job:parent-uuid:children", job_id)
+    mock_r.sadd.assert_called_once_with(f"job:{job_id}:pending", "parent-uuid")
+
+
+def test_submit_completed_parent_releases(client):
+    """POST /submit queues a job immediately when its only parent already completed."""
+    import json
+    c, mock_r = client
+    mock_r.exists.return_value = 1
+    # register with parent, SREM + SCARD (last pending parent removed), release push
+    mock_r.pipeline.return_value.execute.side_effect = [[1, True, "completed"], [1, 0], [1, 1]]
+    mock_r.hmget.return_value = ["waiting", None]
+    mock_r.hget.side_effect = lambda key, field: '{"id": "child"}' if field == "payload" else "waiting"
+
+    resp = c.post("/submit", json={"task": "step2", "depends_on": ["parent-uuid"]})
+    assert resp.status_code == 200
+    job_id = resp.get_json()["id"]
+    mock_r.pipeline.return_value.srem.assert_called_once_with(f"job:{job_id}:pending", "parent-uuid")
+    mapping = mock_r.pipeline.return_value.hset.call_args[1]["mapping"]
+    assert mapping["status"] == "queued"
+    assert "enqueued_at" in json.loads(mapping["payload"])
+
+
+def test_submit_parent_already_counted_not_released(client):
+    """A parent that was already removed from the child's pending set (SREM returns 0) does not release it again."""
+    c, mock_r = client
+    mock_r.exists.return_value = 1
+    mock_r.pipeline.return_value.execute.side_effect = [[1, True, "completed"], [0, 0]]
+    mock_r.hget.return_value = "queued"
+
+    resp = c.post("/submit", json={"task": "step2", "depends_on": ["parent-uuid"]})
+    assert resp.status_code == 200
+    mock_r.hmget.assert_not_called()
+    mock_r.rpush.assert_not_called()
+
+
+def test_submit_dag_cycle(client):
+    """POST /submit with jobs returns 400 when the batch contains a cycle."""
+    c, mock_r = client
+
+    resp = c.post("/submit", json={"jobs": [
+        {"ref": "a", "task": "a", "depends_on": ["b"]},
+        {"ref": "b", "task": "b", "depends_on": ["a"]},
+    ]})
+    assert resp.status_code == 400
+    assert resp.get_json() == {"error": "Dependency cycle in 'jobs'"}
+    mock_r.hset.assert_not_called()
+
+
+def test_submit_dag_duplicate_ref(client):
+    """POST /submit with jobs returns 400 when refs are missing or repeated."""
+    c, mock_r = client
+
+    resp = c.post("/submit", json={"jobs": [{"ref": "a", "task": "a"}, {"ref": "a", "task": "b"}]})
+    assert resp.status_code == 400
+    assert resp.get_json() == {"error": "Each job in 'jobs' needs a unique 'ref'"}
+
+
+def test_submit_dag(client):
+    """POST /submit with jobs creates parents before children and maps refs to ids."""
+    c, mock_r = client
+    mock_r.pipeline.return_value.execute.return_value = [1, True, "queued"]
+    mock_r.hget.return_value = "waiting"
+
+    resp = c.post("/submit", json={"jobs": [
+        {"ref": "load", "task": "load", "depends_on": ["extract-a", "extract-b"]},
+        {"ref": "extract-a", "task": "extract"},
+        {"ref": "extract-b", "task": "extract"},
+    ]})
+    assert resp.status_code == 200
+    jobs = resp.get_json()["jobs"]
+    assert [job["ref"] for job in jobs] == ["load", "extract-a", "extract-b"]
+    assert [job["status"] for job in jobs] == ["waiting", "queued", "queued"]
+    sadds = mock_r.pipeline.return_value.sadd.call_args_list
+    assert [call[0][0] for call in sadds] == [f"job:{jobs[1]['id']}:children", f"job:{jobs[2]['id']}:children"]
+    assert mock_r.incr.call_count == 3
+
+
+def test_cancel_waiting_job(client):
+    """POST /jobs/:id/cancel cancels a waiting job without touching job_queue."""
+    c, mock_r = client
+    mock_r.hgetall.return_value = {"status": "waiting", "task": "step2", "payload": '{"id": "some-uuid"}'}
+    mock_r.smembers.return_value = set()
+
+    resp = c.post("/jobs/some-uuid/cancel")
+    assert resp.status_code == 200
+    assert resp.get_json() == {"status": "cancelled", "id": "some-uuid"}
+    mock_r.lrem.assert_not_called()
+    mock_r.smembers.assert_called_once_with("job:some-uuid:children")
+
+
+def test_submit_carries_trace_id(client):
+    """POST /submit returns a trace_id and stores it in the job hash and queued payload."""
+    import json
+    c, mock_r = client
+
+    resp = c.post("/submit", json={"task": "hello"})
+    trace_id = resp.get_json()["trace_id"]
+    assert len(trace_id) == 32
+    assert mock_r.hset.call_args[1]["mapping"]["trace_id"] == trace_id
+    queued = json.loads(mock_r.rpush.call_args[0][1])
+    assert queued["trace_id"] == trace_id
+    assert "enqueued_at" in queued
+
+
+def test_submit_exports_span(client, tmp_path):
+    """With TRACE_EXPORTER=file, POST /submit appends an api.submit span to TRACE_FILE."""
+    import json
+    c, mock_r = client
+    trace_file = tmp_path / "traces.jsonl"
+
+    with patch("main.TRACE_EXPORTER", "file"), patch("main.TRACE_FILE", str(trace_file)):
+        resp = c.post("/submit", json={"task": "hello"})
+
+    spans = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    assert len(spans) == 1
+    assert spans[0]["name"] == "api.submit"
+    assert spans[0]["trace_id"] == resp.get_json()["trace_id"]
+    assert spans[0]["job_id"] == resp.get_json()["id"]
+    assert spans[0]["duration_ms"] >= 0
+
+
+def test_submit_completed_parent_cancelled_child_not_released(client):
+    """A child whose cancel was requested is not pushed to job_queue when its last parent completes."""
+    c, mock_r = client
+    mock_r.exists.return_value = 1
+    mock_r.pipeline.return_value.execute.side_effect = [[1, True, "completed"], [1, 0]]
+    mock_r.hmget.return_value = ["waiting", "1"]
+    mock_r.hget.return_value = "cancelled"
+
+    resp = c.post("/submit", json={"task": "step2", "depends_on": ["parent-uuid"]})
+    assert resp.status_code == 200
+    mock_r.rpush.assert_not_called()
+    mock_r.pipeline.return_value.hset.assert_not_called()
+
+
+def test_submit_dag_invalid_node_logged(client):
+    """POST /submit with jobs logs the same 400 warning as a single submit for an invalid node."""
+    c, mock_r = client
+
+    with patch("main.log") as mock_log:
+        resp = c.post("/submit", json={"jobs": [{"ref": "a", "task": "a", "timeout_seconds": -1}]})
+    assert resp.status_code == 400
+    assert resp.get_json() == {"error": "'timeout_seconds' must be a positive number"}
+    mock_log.warning.assert_called_once_with(
+        "Submit failed: invalid timeout_seconds", extra={"path": "/submit", "status_code": 400}
+    )
+
+
+def test_unknown_trace_exporter_exports_nothing(client, capsys):
+    """An unrecognised TRACE_EXPORTER value never falls through to the stdout exporter."""
+    c, mock_r = client
+
+    with patch("main.TRACE_EXPORTER", "otlp"):
+        resp = c.post("/submit", json={"task": "hello"})
+    assert resp.status_code == 200
+    assert capsys.readouterr().out == ""
+
+
+def test_submit_span_export_failure_does_not_fail_request(client, tmp_path):
+    """An unwritable TRACE_FILE is logged; POST /submit still returns 200 for the already-queued job."""
+    c, mock_r = client
+
+    with patch("main.TRACE_EXPORTER", "file"), patch("main.TRACE_FILE", str(tmp_path / "missing" / "t.jsonl")):
+        resp = c.post("/submit", json={"task": "hello"})
+    assert resp.status_code == 200
+    mock_r.rpush.assert_called_once()
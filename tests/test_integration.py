@@ -75,3 +75,105 @@ def test_submit_fail_moves_to_dlq(stack):
         time.sleep(POLL_INTERVAL)
 
     pytest.fail(f"Job did not reach failed status in {POLL_TIMEOUT}s")
+
+
+@pytest.mark.integration
+def test_submit_timeout_moves_to_dlq(stack):
+    """Submit a job whose timeout is shorter than the 2s handler; watchdog fails it with error_type=timeout."""
+    resp = requests.post(
+        f"{API_URL}/submit",
+        json={"task": "integration-timeout", "timeout_seconds": 0.5},
+        headers={"Content-Type": "application/json"},
+        timeout=5,
+    )
+    assert resp.status_code == 200
+    job_id = resp.json()["id"]
+
+    start = time.time()
+    while time.time() - start < POLL_TIMEOUT:
+        r = requests.get(f"{API_URL}/jobs/{job_id}", timeout=5)
+        data = r.json()
+        if data["status"] == "failed":
+            assert data["error_type"] == "timeout"
+            return
+        if data["status"] == "completed":
+            pytest.fail("Job completed despite timeout")
+        time.sleep(POLL_INTERVAL)
+
+    pytest.fail(f"Job did not reach failed status in {POLL_TIMEOUT}s")
+
+
+@pytest.mark.integration
+def test_cancel_processing_job(stack):
+    """Cancel a running job; worker terminates the handler and marks it cancelled."""
+    resp = requests.post(f"{API_URL}/submit", json={"task": "integration-cancel"}, timeout=5)
+    job_id = resp.json()["id"]
+
+    start = time.time()
+    while time.time() - start < POLL_TIMEOUT:
+        status = requests.get(f"{API_URL}/jobs/{job_id}", timeout=5).json()["status"]
+        if status == "processing":
+            break
+        time.sleep(0.1)
+
+    resp = requests.post(f"{API_URL}/jobs/{job_id}/cancel", timeout=5)
+    assert resp.status_code in (200, 202)
+
+    start = time.time()
+    while time.time() - start < POLL_TIMEOUT:
+        data = requests.get(f"{API_URL}/jobs/{job_id}", timeout=5).json()
+        if data["status"] == "cancelled":
+            assert "cancelled_at" in data
+            return
+        time.sleep(POLL_INTERVAL)
+
+    pytest.fail(f"Job was not cancelled in {POLL_TIMEOUT}s; last status: {data['status']}")
+
+
+@pytest.mark.integration
+def test_dag_fan_out_fan_in(stack):
+    """Submit a diamond DAG in one request; every node completes, children only after their parents."""
+    resp = requests.post(
+        f"{API_URL}/submit",
+        json={"jobs": [
+            {"ref": "extract", "task": "extract"},
+            {"ref": "left", "task": "transform", "depends_on": ["extract"]},
+            {"ref": "right", "task": "transform", "depends_on": ["extract"]},
+            {"ref": "load", "task": "load", "depends_on": ["left", "right"]},
+        ]},
+        timeout=5,
+    )
+    assert resp.status_code == 200
+    ids = {job["ref"]: job["id"] for job in resp.json()["jobs"]}
+
+    start = time.time()
+    while time.time() - start < POLL_TIMEOUT:
+        load = requests.get(f"{API_URL}/jobs/{ids['load']}", timeout=5).json()
+        if load["status"] == "completed":
+            break
+        assert load["status"] in ("waiting", "queued", "processing")
+        time.sleep(POLL_INTERVAL)
+    else:
+        pytest.fail(f"DAG sink did not complete in {POLL_TIMEOUT}s; last status: {load['status']}")
+
+    parents = [requests.get(f"{API_URL}/jobs/{ids[ref]}", timeout=5).json() for ref in ("left", "right")]
+    assert all(parent["completed_at"] <= load["completed_at"] for parent in parents)
+
+
+@pytest.mark.integration
+def test_failed_parent_cancels_children(stack):
+    """A parent that ends in the DLQ cancels its waiting child."""
+    parent_id = requests.post(f"{API_URL}/submit", json={"task": "fail"}, timeout=5).json()["id"]
+    child = requests.post(f"{API_URL}/submit", json={"task": "child", "depends_on": [parent_id]}, timeout=5).json()
+    # The parent may already have exhausted its retries by the time the child registers
+    assert child["status"] in ("waiting", "cancelled")
+
+    start = time.time()
+    while time.time() - start < POLL_TIMEOUT:
+        data = requests.get(f"{API_URL}/jobs/{child['id']}", timeout=5).json()
+        if data["status"] == "cancelled":
+            assert parent_id in data["error"]
+            return
+        time.sleep(POLL_INTERVAL)
+
+    pytest.fail(f"Child was not cancelled in {POLL_TIMEOUT}s; last status: {data['status']}")
@@ -1,8 +1,10 @@
+import json
 import pytest
 import subprocess
 import time
 import requests
 from pathlib import Path
+from unittest.mock import patch, MagicMock
 
 API_URL = "http://localhost:5001"
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
@@ -67,3 +69,83 @@ def test_reconciler_requeues_stale_job(stack):
         time.sleep(0.5)
     
     pytest.fail(f"Job did not complete after worker restart. Status: {r.json()['status']}")
+
+
+@pytest.fixture
+def reconciler():
+    """reconciler module with mocked Redis."""
+    import reconciler
+    mock_redis = MagicMock()
+    with patch("reconciler.r", mock_redis):
+        yield reconciler, mock_redis
+
+
+def test_reconcile_job_not_processing(reconciler):
+    """A job that already left processing is only removed from the ZSET."""
+    rec, mock_r = reconciler
+    mock_r.hgetall.return_value = {"status": "completed"}
+
+    rec.reconcile_job("job-1")
+    mock_r.zrem.assert_called_once_with("processing_jobs", "job-1")
+    mock_r.pipeline.assert_not_called()
+
+
+def test_reconcile_job_requeues_stale(reconciler):
+    """A stale job under MAX_ATTEMPTS is requeued with the stored payload kept in sync."""
+    rec, mock_r = reconciler
+    mock_r.hgetall.return_value = {
+        "status": "processing",
+        "payload": json.dumps({"id": "job-1", "task": "hello", "attempts": 0, "trace_id": "t"}),
+    }
+
+    rec.reconcile_job("job-1")
+    pipeline = mock_r.pipeline.return_value
+    queue, payload = pipeline.rpush.call_args[0]
+    assert queue == "job_queue"
+    assert json.loads(payload)["attempts"] == 1
+    assert pipeline.hset.call_args[1]["mapping"]["payload"] == payload
+
+
+def test_reconcile_job_dlq_cancels_dependents(reconciler):
+    """A stale job at MAX_ATTEMPTS goes to dead_letter and cancels its waiting children."""
+    rec, mock_r = reconciler
+    mock_r.hgetall.return_value = {
+        "status": "processing",
+        "attempts": str(rec.MAX_ATTEMPTS - 1),
+        "payload": json.dumps({"id": "job-1", "task": "hello", "attempts": rec.MAX_ATTEMPTS - 1}),
+    }
+    mock_r.smembers.side_effect = lambda key: {"child-1"} if key == "job:job-1:children" else set()
+    mock_r.hget.return_value = "waiting"
+
+    rec.reconcile_job("job-1")
+    assert mock_r.pipeline.return_value.rpush.call_args[0][0] == "dead_letter"
+    mock_r.hset.assert_called_once()
+    key = mock_r.hset.call_args[0][0]
+    mapping = mock_r.hset.call_args[1]["mapping"]
+    assert key == "job:child-1"
+    assert mapping["status"] == "cancelled"
+    assert mapping["error"] == "Dependency job-1 failed"
+
+
+def test_reconcile_job_missing_payload_cancels_dependents(reconciler):
+    """A stale job with no payload is failed and its waiting children are cancelled."""
+    rec, mock_r = reconciler
+    mock_r.hgetall.return_value = {"status": "processing"}
+    mock_r.smembers.side_effect = lambda key: {"child-1"} if key == "job:job-1:children" else set()
+    mock_r.hget.return_value = "waiting"
+
+    rec.reconcile_job("job-1")
+    keys = [call[0][0] for call in mock_r.hset.call_args_list]
+    assert keys == ["job:job-1", "job:child-1"]
+    assert mock_r.hset.call_args[1]["mapping"]["status"] == "cancelled"
+
+
+def test_cancel_dependents_skips_non_waiting(reconciler):
+    """Children that were already released (not waiting) are left alone, and the walk stops there."""
+    rec, mock_r = reconciler
+    mock_r.smembers.side_effect = lambda key: {"child-1"} if key == "job:job-1:children" else {"grandchild"}
+    mock_r.hget.return_value = "queued"
+
+    rec.cancel_dependents("job-1", "failed")
+    mock_r.hset.assert_not_called()
+    mock_r.smembers.assert_called_once_with("job:job-1:children")
@@ -0,0 +1,230 @@
+"""Unit tests for the worker service."""
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+import redis
+from unittest.mock import patch, MagicMock
+
+
+@pytest.fixture
+def worker():
+    """worker module with mocked Redis."""
+    import worker
+    mock_redis = MagicMock()
+    mock_redis.hmget.return_value = ["queued", None]
+    with patch("worker.r", mock_redis):
+        yield worker, mock_redis
+
+
+def job_json(**kwargs) -> str:
+    return json.dumps({"id": "job-1", "task": "hello", "attempts": 0, "created_at": "2025-02-03T12:00:00+00:00", **kwargs})
+
+
+def test_process_job_skips_cancel_requested(worker):
+    """A popped job with cancel_requested set is marked cancelled and never claimed or run."""
+    w, mock_r = worker
+    mock_r.hmget.return_value = ["queued", "1"]
+    mock_r.smembers.return_value = set()
+
+    with patch("worker.run_with_watchdog") as run:
+        w.process_job(job_json())
+    run.assert_not_called()
+    mock_r.pipeline.assert_not_called()
+    assert mock_r.hset.call_args[1]["mapping"]["status"] == "cancelled"
+
+
+def test_process_job_completes(worker):
+    """A successful handler marks the job completed and releases no children when it has none."""
+    w, mock_r = worker
+    mock_r.pipeline.return_value.execute.side_effect = [[1, 1], [1, set()]]
+
+    with patch("worker.run_with_watchdog", return_value="completed"):
+        w.process_job(job_json())
+    mapping = mock_r.pipeline.return_value.hset.call_args[1]["mapping"]
+    assert mapping["status"] == "completed"
+    assert mapping["result"] == "completed"
+    mock_r.incr.assert_called_once_with("metrics:jobs_completed")
+    mock_r.zrem.assert_called_once_with("processing_jobs", "job-1")
+    mock_r.rpush.assert_not_called()
+
+
+def test_process_job_timeout_retries(worker):
+    """A timed-out attempt is requeued with attempts+1 and the stored payload kept in sync."""
+    w, mock_r = worker
+
+    with patch("worker.run_with_watchdog", side_effect=w.JobTimeoutError("Job timed out after 1s")):
+        w.process_job(job_json(timeout_seconds=1))
+    queue, payload = mock_r.rpush.call_args[0]
+    assert queue == "job_queue"
+    assert json.loads(payload)["attempts"] == 1
+    assert json.loads(payload)["timeout_seconds"] == 1
+    assert mock_r.hset.call_args[1]["mapping"] == {"status": "queued", "payload": payload}
+
+
+@pytest.mark.parametrize("error_class, error_type", [
+    ("RuntimeError", "error"),
+    ("JobTimeoutError", "timeout"),
+    ("JobCrashedError", "crash"),
+])
+def test_process_job_last_attempt_moves_to_dlq(worker, error_class, error_type):
+    """The final failed attempt goes to dead_letter with error_type distinguishing timeouts and crashes."""
+    w, mock_r = worker
+    mock_r.smembers.return_value = set()
+    error = getattr(w, error_class, RuntimeError)("boom")
+
+    with patch("worker.run_with_watchdog", side_effect=error):
+        w.process_job(job_json(attempts=w.MAX_ATTEMPTS - 1))
+    mapping = mock_r.hset.call_args[1]["mapping"]
+    assert mapping["status"] == "failed"
+    assert mapping["error"] == str(error)
+    assert mapping["error_type"] == error_type
+    assert mock_r.rpush.call_args[0][0] == "dead_letter"
+    mock_r.incr.assert_called_once_with("metrics:jobs_failed")
+
+
+def test_process_job_cancelled_while_running(worker):
+    """JobCancelledError marks the job cancelled without retrying it."""
+    w, mock_r = worker
+    mock_r.smembers.return_value = set()
+
+    with patch("worker.run_with_watchdog", side_effect=w.JobCancelledError("Job cancelled")):
+        w.process_job(job_json())
+    assert mock_r.hset.call_args[1]["mapping"]["status"] == "cancelled"
+    mock_r.zrem.assert_called_once_with("processing_jobs", "job-1")
+    mock_r.rpush.assert_not_called()
+
+
+def test_process_job_completion_write_failure_not_retried(worker):
+    """A Redis error after the handler succeeded is logged, not sent through retry/DLQ."""
+    w, mock_r = worker
+    mock_r.pipeline.return_value.execute.side_effect = [[1, 1], redis.ConnectionError("boom")]
+
+    with patch("worker.run_with_watchdog", return_value="completed"):
+        w.process_job(job_json())
+    mock_r.rpush.assert_not_called()
+    mock_r.incr.assert_not_called()
+
+
+@pytest.fixture
+def fast_watchdog(worker):
+    """worker with a short poll interval; fails if a test leaves a handler process running."""
+    with patch("worker.WATCHDOG_POLL_SECONDS", 0.05):
+        yield worker
+    assert multiprocessing.active_children() == []
+
+
+def test_watchdog_returns_result(fast_watchdog):
+    """The handler's return value comes back from the child process."""
+    w, mock_r = fast_watchdog
+    mock_r.hget.return_value = None
+
+    with patch("worker.run_handler", side_effect=lambda task, inputs: f"{task}:{inputs['parent']}"):
+        assert w.run_with_watchdog("job-1", "hello", {"parent": "done"}, 0) == "hello:done"
+
+
+def test_watchdog_reraises_handler_error(fast_watchdog):
+    """A handler exception is re-raised in the worker for the retry/DLQ path."""
+    w, mock_r = fast_watchdog
+    mock_r.hget.return_value = None
+
+    with pytest.raises(RuntimeError, match="Simulated failure"):
+        w.run_with_watchdog("job-1", "fail", {}, 0)
+
+
+def test_watchdog_timeout_terminates_handler(fast_watchdog):
+    """A handler past timeout_seconds is killed and the attempt fails with JobTimeoutError."""
+    w, mock_r = fast_watchdog
+    mock_r.hget.return_value = None
+
+    with patch("worker.run_handler", side_effect=lambda task, inputs: time.sleep(30)):
+        with pytest.raises(w.JobTimeoutError):
+            w.run_with_watchdog("job-1", "hello", {}, 0.2)
+
+
+def test_watchdog_cancel_terminates_handler(fast_watchdog):
+    """cancel_requested seen while polling kills the handler."""
+    w, mock_r = fast_watchdog
+    mock_r.hget.side_effect = [None, None, "1"]
+
+    with patch("worker.run_handler", side_effect=lambda task, inputs: time.sleep(30)):
+        with pytest.raises(w.JobCancelledError):
+            w.run_with_watchdog("job-1", "hello", {}, 0)
+
+
+def test_watchdog_heartbeats_processing_score(fast_watchdog):
+    """Each poll refreshes the processing_jobs score so long jobs are not reconciled as stale."""
+    w, mock_r = fast_watchdog
+    mock_r.hget.return_value = None
+
+    with patch("worker.run_handler", side_effect=lambda task, inputs: time.sleep(0.3) or "completed"):
+        before = time.time()
+        assert w.run_with_watchdog("job-1", "hello", {}, 0) == "completed"
+    assert mock_r.zadd.call_count >= 2
+    (key, scores), _ = mock_r.zadd.call_args
+    assert key == "processing_jobs"
+    assert scores["job-1"] >= before
+
+
+def test_watchdog_cancel_before_start_skips_handler(fast_watchdog):
+    """cancel_requested set before start means no handler process is spawned."""
+    w, mock_r = fast_watchdog
+    mock_r.hget.return_value = "1"
+
+    with patch("worker.multiprocessing.Process") as process:
+        with pytest.raises(w.JobCancelledError):
+            w.run_with_watchdog("job-1", "hello", {}, 0)
+    process.assert_not_called()
+
+
+def test_watchdog_child_crash_fails_attempt(fast_watchdog):
+    """A handler process that dies without a result (e.g. OOM kill) is a failed attempt, not a hang."""
+    w, mock_r = fast_watchdog
+    mock_r.hget.return_value = None
+
+    with patch("worker.run_handler", side_effect=lambda task, inputs: os._exit(3)):
+        with pytest.raises(w.JobCrashedError, match="code 3"):
+            w.run_with_watchdog("job-1", "hello", {}, 0)
+
+
+def test_watchdog_redis_error_terminates_handler(fast_watchdog):
+    """A Redis error while polling for cancellation still kills the running handler."""
+    w, mock_r = fast_watchdog
+    mock_r.hget.side_effect = [None, redis.ConnectionError("boom")]
+
+    with patch("worker.run_handler", side_effect=lambda task, inputs: time.sleep(30)):
+        with pytest.raises(redis.ConnectionError):
+            w.run_with_watchdog("job-1", "hello", {}, 0)
+
+
+def test_release_if_ready_last_parent(worker):
+    """Removing the last pending parent pushes the waiting child onto job_queue."""
+    w, mock_r = worker
+    mock_r.pipeline.return_value.execute.side_effect = [[1, 0], [1, 1]]
+    mock_r.hmget.return_value = ["waiting", None]
+    mock_r.hget.return_value = '{"id": "child"}'
+
+    assert w.release_if_ready("child", "parent") is True
+    mock_r.pipeline.return_value.srem.assert_called_once_with("job:child:pending", "parent")
+    assert json.loads(mock_r.pipeline.return_value.rpush.call_args[0][1])["id"] == "child"
+
+
+def test_release_if_ready_duplicate_parent(worker):
+    """A parent already removed from the pending set (ran twice) does not release the child again."""
+    w, mock_r = worker
+    mock_r.pipeline.return_value.execute.return_value = [0, 0]
+
+    assert w.release_if_ready("child", "parent") is False
+    mock_r.hmget.assert_not_called()
+
+
+def test_release_if_ready_cancel_requested(worker):
+    """A child with cancel_requested is never released."""
+    w, mock_r = worker
+    mock_r.pipeline.return_value.execute.return_value = [1, 0]
+    mock_r.hmget.return_value = ["waiting", "1"]
+
+    assert w.release_if_ready("child", "parent") is False
+    mock_r.pipeline.return_value.rpush.assert_not_called()
@@ -3,6 +3,12 @@ import json
 import time
 import os
 import socket
+import multiprocessing
+import sys
+import cProfile
+import random
+import uuid
+from contextlib import contextmanager
 from datetime import datetime, timezone
 import logging
 from pythonjsonlogger.json import JsonFormatter
@@ -15,6 +21,18 @@ r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
 # Max total attempts before DLQ: 4 attempts = 1 initial + 3 retries ("retried up to 3x")
 MAX_ATTEMPTS = 4
 
+# Default per-job timeout when the payload has no timeout_seconds (0 = no timeout)
+DEFAULT_JOB_TIMEOUT_SECONDS = float(os.getenv("DEFAULT_JOB_TIMEOUT_SECONDS", 0))
+# How often the watchdog checks the handler for completion, timeout and cancellation
+WATCHDOG_POLL_SECONDS = float(os.getenv("WATCHDOG_POLL_SECONDS", 0.5))
+
+# Stage tracing: one JSON line per span, to stdout or TRACE_FILE ("none" disables)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "/tmp/traces.jsonl")
+# Opt-in profiling: cProfile dumps for this percentage of jobs (0 = off)
+PROFILE_SAMPLE_PERCENT = float(os.getenv("PROFILE_SAMPLE_PERCENT", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+
 # Structured logging: JSON to stdout for containers and log collectors
 WORKER_ID = f"worker-{socket.gethostname()}-{os.getpid()}"
 log = logging.getLogger("worker")
@@ -24,97 +42,398 @@ formatter = JsonFormatter("%(message)s %(asctime)s %(levelname)s")
 handler.setFormatter(formatter)
 log.addHandler(handler)
 
+if TRACE_EXPORTER not in ("none", "stdout", "file"):
+    log.warning("Unknown TRACE_EXPORTER, tracing disabled", extra={"trace_exporter": TRACE_EXPORTER})
+    TRACE_EXPORTER = "none"
+
 
 def job_extra(job_id: str, task: str, status: str, **kwargs) -> dict:
     """Build extra dict for structured log fields."""
     return {"job_id": job_id, "task": task, "status": status, "worker_id": WORKER_ID, **kwargs}
 
 
-log.info("Worker starting, connecting to Redis", extra={"worker_id": WORKER_ID, "status": "startup"})
+def export_span(name: str, trace_id: str, start: float, end: float, **attrs):
+    """Write one finished span to the configured exporter. Exporter errors are logged, never raised."""
+    if TRACE_EXPORTER not in ("stdout", "file") or not trace_id:
+        return
+    try:
+        record = json.dumps({
+            "trace_id": trace_id,
+            "span_id": uuid.uuid4().hex[:16],
+            "name": name,
+            "service": "worker",
+            "worker_id": WORKER_ID,
+            "start": start,
+            "duration_ms": round((end - start) * 1000, 3),
+            **attrs,
+        })
+        if TRACE_EXPORTER == "file":
+            with open(TRACE_FILE, "a") as f:
+                f.write(record + "\n")
+        else:
+            print(record, flush=True)
+    except Exception as e:
+        # Tracing must never change job control flow (e.g. a 500 after the job was already queued)
+        log.warning("Span export failed", extra={"span": name, "trace_id": trace_id, "error": str(e)})
+
+
+@contextmanager
+def span(name: str, trace_id: str, **attrs):
+    """Time a stage and export it as a span. The yielded dict can be updated with attributes."""
+    start = time.time()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs["error"] = str(e)
+        raise
+    finally:
+        export_span(name, trace_id, start, time.time(), **attrs)
+
+
+class JobTimeoutError(Exception):
+    """Handler exceeded the job's timeout_seconds; retried/DLQ'd like any other failure."""
+
+
+class JobCancelledError(Exception):
+    """Job was cancelled via POST /jobs/<id>/cancel while running; never retried."""
+
+
+class JobCrashedError(Exception):
+    """Handler process died without reporting a result (os._exit, segfault, OOM kill); retried/DLQ'd."""
+
+
+def run_handler(task: str, inputs: dict) -> str:
+    """Job logic. Runs in a per-job child process so the watchdog can terminate it.
+
+    inputs maps each depends_on job id to that parent's result (fan-in).
+    """
+    if task == "fail":
+        raise RuntimeError("Simulated failure for testing")
+
+    time.sleep(2)
+    return "completed"
+
+
+def run_handler_profiled(profile_path: str, task: str, inputs: dict) -> str:
+    """run_handler under cProfile in the child; stats are dumped even if it raises."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(run_handler, task, inputs)
+    finally:
+        profiler.dump_stats(profile_path)
+
+
+def run_in_child(conn, task: str, inputs: dict, profile_path: str = None):
+    """Child process target: run the handler and send (ok, result or exception) back over conn."""
+    # Forked while the worker's job profiler may be enabled; don't inherit its hook
+    sys.setprofile(None)
+    try:
+        if profile_path:
+            outcome = (True, run_handler_profiled(profile_path, task, inputs))
+        else:
+            outcome = (True, run_handler(task, inputs))
+    except Exception as e:
+        outcome = (False, e)
+    try:
+        conn.send(outcome)
+    except Exception:
+        # Unpicklable result or exception: report it as a plain failure
+        conn.send((False, RuntimeError(str(outcome[1]))))
+    conn.close()
+
+
+def run_with_watchdog(job_id: str, task: str, inputs: dict, timeout_seconds: float, profile_path: str = None) -> str:
+    """Run the handler in its own process, terminating it on timeout, cancellation or any watchdog error.
+
+    A child that exits without reporting a result fails the attempt with JobCrashedError. Each poll refreshes
+    the job's processing_jobs score, so timeouts longer than the reconciler's stale threshold are safe.
+    """
+    # Cancelled between claim and start: don't run the handler at all
+    if r.hget(f"job:{job_id}", "cancel_requested"):
+        raise JobCancelledError("Job cancelled")
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    child = multiprocessing.Process(target=run_in_child, args=(writer, task, inputs, profile_path), daemon=True)
+    child.start()
+    # Only the child holds the write end now, so its death shows up as EOF on reader
+    writer.close()
+    deadline = time.monotonic() + timeout_seconds if timeout_seconds else None
+
+    try:
+        while True:
+            wait = WATCHDOG_POLL_SECONDS
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise JobTimeoutError(f"Job timed out after {timeout_seconds}s")
+                wait = min(wait, remaining)
+            if reader.poll(wait):
+                try:
+                    ok, value = reader.recv()
+                except EOFError:
+                    child.join()
+                    raise JobCrashedError(f"Handler process exited with code {child.exitcode}")
+                if ok:
+                    return value
+                raise value
+            # Heartbeat: keep the claim fresh so the reconciler doesn't requeue a job that is still running
+            r.zadd("processing_jobs", {job_id: datetime.now(timezone.utc).timestamp()})
+            if r.hget(f"job:{job_id}", "cancel_requested"):
+                raise JobCancelledError("Job cancelled")
+    finally:
+        # Whatever ended the wait (result, timeout, cancel, Redis error), never leave the handler running
+        if child.is_alive():
+            child.terminate()
+        child.join()
+        reader.close()
+
+
+def parent_results(job: dict) -> dict:
+    """Read the result of every job this one depends on."""
+    parent_ids = job.get("depends_on", [])
+    if not parent_ids:
+        return {}
+    pipeline = r.pipeline()
+    for parent_id in parent_ids:
+        pipeline.hget(f"job:{parent_id}", "result")
+    return dict(zip(parent_ids, pipeline.execute()))
+
+
+def release_if_ready(job_id: str, parent_id: str) -> bool:
+    """Mark parent_id done for a waiting job; the caller that removes its last pending parent pushes it to job_queue.
+
+    SREM is idempotent per parent, so a parent that completes twice (e.g. requeued by the reconciler while
+    still running) cannot release its children early.
+    """
+    key = f"job:{job_id}"
+    pipeline = r.pipeline()
+    pipeline.srem(f"{key}:pending", parent_id)
+    pipeline.scard(f"{key}:pending")
+    removed, remaining = pipeline.execute()
+    if not removed or remaining != 0:
+        return False
+    status, cancel_requested = r.hmget(key, "status", "cancel_requested")
+    if status != "waiting" or cancel_requested:
+        return False
+    payload = json.loads(r.hget(key, "payload"))
+    payload["enqueued_at"] = time.time()  # Queue wait starts at release, not at submit
+    payload_json = json.dumps(payload)
+    pipeline = r.pipeline()
+    pipeline.hset(key, mapping={"status": "queued", "payload": payload_json})
+    pipeline.rpush("job_queue", payload_json)
+    pipeline.execute()
+    return True
+
+
+def cancel_dependents(job_id: str, reason: str):
+    """Cancel every waiting job downstream of job_id (depth-first over job:<id>:children)."""
+    stack = [job_id]
+    while stack:
+        parent_id = stack.pop()
+        for child_id in r.smembers(f"job:{parent_id}:children"):
+            if r.hget(f"job:{child_id}", "status") != "waiting":
+                continue
+            r.hset(
+                f"job:{child_id}",
+                mapping={
+                    "status": "cancelled",
+                    "error": f"Dependency {job_id} {reason}",
+                    "cancel_requested": "1",
+                    "cancelled_at": datetime.now(timezone.utc).isoformat(),
+                },
+            )
+            log.info(
+                "Job cancelled by dependency",
+                extra={"job_id": child_id, "status": "cancelled", "worker_id": WORKER_ID, "parent_id": job_id, "reason": reason},
+            )
+            stack.append(child_id)
+
 
-while True:
-    _, job_json = r.blpop("job_queue")
+def process_job(job_json: str):
+    """Claim one popped job, run it under the watchdog, and record completion, retry, DLQ or cancellation."""
     job = json.loads(job_json)
     job_id = job.get("id")
     if not job_id:
         log.warning("Job missing 'id', skipping", extra={"worker_id": WORKER_ID})
-        continue
+        return
 
     task = job.get("task", "")
     attempts = job.get("attempts", 0)
-    created_at = job.get("created_at", "")
+    timeout_seconds = job.get("timeout_seconds") or DEFAULT_JOB_TIMEOUT_SECONDS
+    trace_id = job.get("trace_id")
 
-    now_iso = datetime.now(timezone.utc).isoformat()
-    
-    # Use pipeline to minimize race condition between setting status and adding to ZSET
-    pipeline = r.pipeline()
-    pipeline.hset(
-        f"job:{job_id}",
-        mapping={
-            "status": "processing",
-            "processing_started_at": now_iso,
-            "worker_id": WORKER_ID,
-            "payload": job_json,  # Stored so reconciler can requeue if worker crashes mid-job
-        },
-    )
-    # Add to "processing_jobs" ZSET with score = current timestamp
-    pipeline.zadd("processing_jobs", {job_id: datetime.now(timezone.utc).timestamp()})
-    pipeline.execute()
+    # Cancel may have lost the LREM race with BLPOP, or raced a dependency release: skip without claiming
+    status, cancel_requested = r.hmget(f"job:{job_id}", "status", "cancel_requested")
+    if cancel_requested or status == "cancelled":
+        if status != "cancelled":
+            r.hset(
+                f"job:{job_id}",
+                mapping={
+                    "status": "cancelled",
+                    "cancelled_at": datetime.now(timezone.utc).isoformat(),
+                },
+            )
+        log.info("Cancelled job skipped", extra=job_extra(job_id, task, "cancelled", trace_id=trace_id))
+        cancel_dependents(job_id, "cancelled")
+        return
 
-    log.info("Job claimed", extra=job_extra(job_id, task, "processing"))
+    claim_start = time.time()
+    if job.get("enqueued_at"):
+        export_span("worker.queue_wait", trace_id, job["enqueued_at"], claim_start, job_id=job_id, task=task)
 
-    try:
-        if task == "fail":
-            raise RuntimeError("Simulated failure for testing")
+    profiler = None
+    profile_path = None
+    if PROFILE_SAMPLE_PERCENT and random.uniform(0, 100) < PROFILE_SAMPLE_PERCENT:
+        profile_path = os.path.join(PROFILE_DIR, f"{job_id}-{attempts}")
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-        time.sleep(2)
-        result = "completed"
-        r.hset(
+    now_iso = datetime.now(timezone.utc).isoformat()
+    
+    with span("worker.claim", trace_id, job_id=job_id, task=task):
+        # Use pipeline to minimize race condition between setting status and adding to ZSET
+        pipeline = r.pipeline()
+        pipeline.hset(
             f"job:{job_id}",
             mapping={
-                "status": "completed",
-                "result": result,
-                "completed_at": datetime.now(timezone.utc).isoformat(),
+                "status": "processing",
+                "processing_started_at": now_iso,
+                "worker_id": WORKER_ID,
+                "payload": job_json,  # Stored so reconciler can requeue if worker crashes mid-job
             },
         )
-        r.incr("metrics:jobs_completed")
-        # Remove from tracking set
-        r.zrem("processing_jobs", job_id)
+        # Add to "processing_jobs" ZSET with score = current timestamp
+        pipeline.zadd("processing_jobs", {job_id: datetime.now(timezone.utc).timestamp()})
+        pipeline.execute()
+
+    log.info("Job claimed", extra=job_extra(job_id, task, "processing", trace_id=trace_id))
 
-        log.info("Job completed", extra=job_extra(job_id, task, "completed"))
+    try:
+        with span("worker.handler", trace_id, job_id=job_id, task=task, attempt=attempts + 1):
+            handler_profile = f"{profile_path}.handler.prof" if profile_path else None
+            result = run_with_watchdog(job_id, task, parent_results(job), timeout_seconds, handler_profile)
+
+    except JobCancelledError:
+        with span("worker.cancel", trace_id, job_id=job_id, task=task):
+            r.hset(
+                f"job:{job_id}",
+                mapping={
+                    "status": "cancelled",
+                    "cancelled_at": datetime.now(timezone.utc).isoformat(),
+                },
+            )
+            r.zrem("processing_jobs", job_id)
+            log.info("Job cancelled", extra=job_extra(job_id, task, "cancelled", trace_id=trace_id))
+            cancel_dependents(job_id, "cancelled")
 
     except Exception as e:
         attempts = attempts + 1
+        error = str(e)
+        if isinstance(e, JobTimeoutError):
+            error_type = "timeout"
+        elif isinstance(e, JobCrashedError):
+            error_type = "crash"
+        else:
+            error_type = "error"
+        next_payload = json.dumps({**job, "attempts": attempts, "enqueued_at": time.time()})
         # Retry when under max: 4 total attempts = 3 retries. DLQ only when attempts >= MAX_ATTEMPTS.
         if attempts < MAX_ATTEMPTS:
-            r.hset(f"job:{job_id}", "status", "queued")
-            r.rpush(
-                "job_queue",
-                json.dumps({"id": job_id, "task": task, "attempts": attempts, "created_at": created_at}),
-            )
+            with span("worker.retry", trace_id, job_id=job_id, task=task, attempts=attempts, error_type=error_type):
+                # Keep stored payload in sync with the queued copy so cancel can LREM it
+                r.hset(f"job:{job_id}", mapping={"status": "queued", "payload": next_payload})
+                r.rpush("job_queue", next_payload)
+                # Remove from tracking set (it's back in queue, not processing anymore)
+                r.zrem("processing_jobs", job_id)
             log.warning(
                 "Job retrying",
-                extra=job_extra(job_id, task, "queued", attempts=attempts, max_attempts=MAX_ATTEMPTS, error=str(e)),
+                extra=job_extra(
+                    job_id, task, "queued",
+                    attempts=attempts, max_attempts=MAX_ATTEMPTS, error=error, error_type=error_type, trace_id=trace_id,
+                ),
             )
-            # Remove from tracking set (it's back in queue, not processing anymore)
-            r.zrem("processing_jobs", job_id)
         else:
-            r.hset(
-                f"job:{job_id}",
-                mapping={
-                    "status": "failed",
-                    "error": str(e),
-                    "failed_at": datetime.now(timezone.utc).isoformat(),
-                },
-            )
-            r.rpush(
-                "dead_letter",
-                json.dumps({"id": job_id, "task": task, "attempts": attempts, "created_at": created_at}),
-            )
-            r.incr("metrics:jobs_failed")
-            # Remove from tracking set
-            r.zrem("processing_jobs", job_id)
+            with span("worker.dlq", trace_id, job_id=job_id, task=task, attempts=attempts, error_type=error_type):
+                r.hset(
+                    f"job:{job_id}",
+                    mapping={
+                        "status": "failed",
+                        "error": error,
+                        "error_type": error_type,
+                        "failed_at": datetime.now(timezone.utc).isoformat(),
+                    },
+                )
+                r.rpush("dead_letter", next_payload)
+                r.incr("metrics:jobs_failed")
+                # Remove from tracking set
+                r.zrem("processing_jobs", job_id)
+                cancel_dependents(job_id, "failed")
             log.error(
                 "Job failed, moved to DLQ",
-                extra=job_extra(job_id, task, "failed", attempts=attempts, error=str(e)),
+                extra=job_extra(job_id, task, "failed", attempts=attempts, error=error, error_type=error_type, trace_id=trace_id),
             )
+
+    else:
+        # Completion writes run outside the handler's try: the job already succeeded, so errors here must not
+        # send it back through retry/DLQ. If status=completed never committed, the reconciler requeues the job;
+        # releases are idempotent per parent, so a rerun cannot double-release children.
+        try:
+            with span("worker.complete", trace_id, job_id=job_id, task=task) as attrs:
+                # MULTI/EXEC: status write and children read are atomic w.r.t. the API registering a new child,
+                # so a child registered concurrently is released either here or by the API, never missed.
+                pipeline = r.pipeline()
+                pipeline.hset(
+                    f"job:{job_id}",
+                    mapping={
+                        "status": "completed",
+                        "result": result,
+                        "completed_at": datetime.now(timezone.utc).isoformat(),
+                    },
+                )
+                pipeline.smembers(f"job:{job_id}:children")
+                _, children = pipeline.execute()
+                r.incr("metrics:jobs_completed")
+                # Remove from tracking set
+                r.zrem("processing_jobs", job_id)
+
+                log.info("Job completed", extra=job_extra(job_id, task, "completed", trace_id=trace_id))
+
+                released = 0
+                for child_id in children:
+                    try:
+                        if release_if_ready(child_id, job_id):
+                            released += 1
+                            log.info(
+                                "Job released",
+                                extra={"job_id": child_id, "status": "queued", "worker_id": WORKER_ID, "parent_id": job_id},
+                            )
+                    except Exception as e:
+                        # One child's release failing must not stop its siblings from being released
+                        log.error(
+                            "Job release failed",
+                            extra={"job_id": child_id, "worker_id": WORKER_ID, "parent_id": job_id, "error": str(e)},
+                        )
+                attrs["released"] = released
+        except Exception as e:
+            log.error(
+                "Job completion writes failed",
+                extra=job_extra(job_id, task, "completed", error=str(e), trace_id=trace_id),
+            )
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(f"{profile_path}.worker.prof")
+        log.info("Job profiled", extra=job_extra(job_id, task, "profiled", profile_path=profile_path))
+
+
+def main():
+    log.info("Worker starting, connecting to Redis", extra={"worker_id": WORKER_ID, "status": "startup"})
+
+    if PROFILE_SAMPLE_PERCENT:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    while True:
+        _, job_json = r.blpop("job_queue")
+        process_job(job_json)
+
+
+if __name__ == "__main__":
+    main()